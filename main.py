@@ -1,15 +1,45 @@
-import datetime
 import base64
+import datetime
+import gzip
+import hmac
 import io
+import os
+import random
 import re
-import urllib.parse
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import httplib2
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from googleapiclient.model import JsonModel
+import numpy as np
+import orjson
 import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import searchconsole
 
 IS_LOCAL = False
+_REGEX_SPECIAL_CHARS = re.compile(r"[\\.+*?()|\[\]{}^$]")
+SCOPES = ["https://www.googleapis.com/auth/webmasters.readonly"]
+COOKIE_PREFIX = "gsc/"
+REFRESH_TOKEN_COOKIE = "refresh_token"
+OAUTH_STATE_COOKIE = "oauth_state"
+SIGN_IN_TTL_SECONDS = 600
 SEARCH_TYPES = ["web", "image", "video", "news", "discover", "googleNews"]
 DATE_RANGE_OPTIONS = [
     "Last 7 Days",
@@ -21,39 +51,43 @@ DATE_RANGE_OPTIONS = [
     "Custom Range",
 ]
 BASE_DIMENSIONS = ["page", "query", "country", "date"]
+DEVICE_DIMENSIONS = BASE_DIMENSIONS + ["device"]
 MAX_ROWS = 250_000
+API_ROW_LIMIT = 25_000
+PAGE_FETCH_WINDOW = 4
+METRIC_DTYPES = {
+    "clicks": np.int32,
+    "impressions": np.int32,
+    "ctr": np.float32,
+    "position": np.float32,
+}
+METRIC_FIELDS = [
+    pa.field("clicks", pa.int32()),
+    pa.field("impressions", pa.int32()),
+    pa.field("ctr", pa.float32()),
+    pa.field("position", pa.float32()),
+]
+DIMENSION_TYPE = pa.dictionary(pa.int32(), pa.string())
+COMPARE_KEYS = ["page", "query"]
 DF_PREVIEW_ROWS = 100
+EXPORT_FORMATS = ["CSV", "CSV.gz", "Parquet"]
+HTTP_TIMEOUT_SECONDS = 60
+FETCH_CACHE_TTL_SECONDS = 3600
+FETCH_CACHE_MAX_ENTRIES = 32
+# Clients cached per access token; tokens rotate hourly, so entries expire with them
+TOKEN_CACHE_TTL_SECONDS = 3600
+TOKEN_CACHE_MAX_ENTRIES = 64
+MAX_REQUESTS_PER_SECOND = 5
+MAX_CONCURRENT_REQUESTS = 4
+# Workers are bounded by the GSC quota, not CPU; override per deployment
+MAX_FETCH_WORKERS = int(os.environ.get("GSC_MAX_FETCH_WORKERS", "8"))
+CHUNK_SIZE_DAYS = 90
+MAX_RETRIES = 6
+MAX_BACKOFF_SECONDS = 15
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
 
 ###############################################################################
-# 1) Handle code truncation in older Streamlit with st.experimental_get_query_params()
-###############################################################################
-
-def reassemble_auth_code(params):
-    """
-    Safely extract the 'code' parameter from st.experimental_get_query_params(),
-    and rejoin the slash if it got split.
-    """
-    code_list = params.get("code")
-    if not code_list:
-        return None
-
-    code_val = code_list[0]
-    if not code_val:
-        return None
-
-    # If the code_val is "4" or ends with "/", attempt to rejoin
-    if code_val == "4" or code_val.endswith("/"):
-        leftover_key = None
-        for k in params.keys():
-            if k not in ["code", "state", "scope"]:
-                leftover_key = k
-                break
-        if leftover_key:
-            code_val = code_val.rstrip("/") + "/" + leftover_key.lstrip("/")
-    return code_val
-
-###############################################################################
-# 2) Streamlit page setup & session state init
+# 1) Streamlit page setup & session state init
 ###############################################################################
 
 def setup_streamlit():
@@ -70,7 +104,7 @@ def setup_streamlit():
     4. Optionally, apply keyword or URL filters.
     5. Click "Fetch Data" to retrieve the data.
     6. Optionally, compare data between different time periods.
-    7. Download the results as a CSV file.
+    7. Download the results as CSV, gzipped CSV or Parquet.
     """)
 
 def init_session_state():
@@ -98,6 +132,10 @@ def init_session_state():
         st.session_state.filter_keywords_not = ""
     if "filter_url" not in st.session_state:
         st.session_state.filter_url = ""
+    if "clicks_only" not in st.session_state:
+        st.session_state.clicks_only = False
+    if "export_format" not in st.session_state:
+        st.session_state.export_format = "CSV"
     if "compare" not in st.session_state:
         st.session_state.compare = False
     if "compare_start_date" not in st.session_state:
@@ -106,7 +144,7 @@ def init_session_state():
         st.session_state.compare_end_date = datetime.date.today() - datetime.timedelta(days=7)
 
 ###############################################################################
-# 3) Google OAuth flow setup & GSC property listing
+# 2) Google OAuth flow setup & GSC property listing
 ###############################################################################
 
 def load_config():
@@ -126,51 +164,503 @@ def load_config():
     return client_config
 
 def init_oauth_flow(client_config):
-    scopes = ["https://www.googleapis.com/auth/webmasters.readonly"]
     redirect_uri = client_config["web"]["redirect_uris"][0]
     flow = Flow.from_client_config(
         client_config,
-        scopes=scopes,
+        scopes=SCOPES,
         redirect_uri=redirect_uri
     )
     return flow
 
-def google_auth(client_config):
+class PendingSignIns:
+    """
+    PKCE verifiers of sign-ins waiting for Google's redirect, keyed by OAuth
+    state. The redirect lands in a new Streamlit session, so they can't live
+    in session_state; each entry is single-use and expires after ttl seconds.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._verifiers = {}
+
+    def _expire(self, now):
+        for state, (_, created) in list(self._verifiers.items()):
+            if now - created > self._ttl:
+                del self._verifiers[state]
+
+    def add(self, state, code_verifier):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._verifiers[state] = (code_verifier, now)
+
+    def pop(self, state):
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._verifiers.pop(state, None)
+        return entry[0] if entry else None
+
+@st.cache_resource(show_spinner=False)
+def get_pending_sign_ins():
+    return PendingSignIns(SIGN_IN_TTL_SECONDS)
+
+def start_sign_in(client_config, cookies):
+    """
+    Authorization URL for a new sign-in attempt with its own PKCE verifier
+    and state. With cookies enabled the state is also pinned to this browser,
+    so a code can only be redeemed where its sign-in started.
+    """
     flow = init_oauth_flow(client_config)
-    auth_url, _ = flow.authorization_url(
+    auth_url, state = flow.authorization_url(
         prompt="consent",
         access_type="offline",
         include_granted_scopes="true"
     )
-    return flow, auth_url
+    get_pending_sign_ins().add(state, flow.code_verifier)
+    if cookies is not None:
+        cookies[OAUTH_STATE_COOKIE] = state
+    return auth_url
+
+def exchange_auth_code(client_config, cookies, auth_code, state):
+    """
+    Exchanges the code with the verifier of the sign-in named by state.
+    Raises ValueError for an unknown, expired or reused state, or one this
+    browser didn't start.
+    """
+    if cookies is not None:
+        expected_state = cookies.get(OAUTH_STATE_COOKIE)
+        if expected_state:
+            cookies[OAUTH_STATE_COOKIE] = ""
+        if not state or not expected_state or not hmac.compare_digest(state, expected_state):
+            raise ValueError("sign-in state doesn't match this browser; please sign in again")
+    code_verifier = get_pending_sign_ins().pop(state) if state else None
+    if code_verifier is None:
+        raise ValueError("unknown or expired sign-in; please sign in again")
+
+    flow = init_oauth_flow(client_config)
+    flow.code_verifier = code_verifier
+    flow.fetch_token(code=auth_code)
+    return flow.credentials
+
+def get_cookie_manager():
+    """
+    Cookie store for the refresh token, or None when no cookie_key secret is
+    set; sign-ins then last only for the browser session. The component needs
+    one round-trip to the browser before cookies can be read, so stop until ready.
+    """
+    cookie_key = st.secrets.get("cookie_key")
+    if not cookie_key:
+        return None
+    # Imported here: the package uses st.cache at import time, which newer
+    # Streamlit releases removed, so only cookie-enabled deployments need it
+    from streamlit_cookies_manager import CookieManager
+
+    cookies = CookieManager(prefix=COOKIE_PREFIX)
+    if not cookies.ready():
+        st.stop()
+    return cookies
+
+@st.cache_resource(show_spinner=False)
+def _cookie_fernet(cookie_key):
+    """
+    Fernet cipher for cookie values, keyed off the cookie_key secret once per
+    process rather than re-deriving the key on every rerun.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"gsc/refresh_token")
+    return Fernet(base64.urlsafe_b64encode(hkdf.derive(cookie_key.encode("utf-8"))))
+
+def save_refresh_token(cookies, credentials):
+    if cookies is None or not credentials.refresh_token:
+        return
+    fernet = _cookie_fernet(st.secrets["cookie_key"])
+    cookies[REFRESH_TOKEN_COOKIE] = fernet.encrypt(credentials.refresh_token.encode("utf-8")).decode("ascii")
+
+def forget_refresh_token(cookies):
+    # Overwrite rather than del: CookieManager.__delitem__ looks the key up
+    # without its prefix and silently queues nothing
+    if cookies is not None and cookies.get(REFRESH_TOKEN_COOKIE):
+        cookies[REFRESH_TOKEN_COOKIE] = ""
+
+def save_cookies(cookies):
+    """
+    Sends queued cookie changes to the browser. The save component has a
+    fixed key, so this runs at most once per script run.
+    """
+    if cookies is not None:
+        cookies.save()
+
+def load_credentials_from_cookie(cookies, client_config):
+    """
+    Rebuilds credentials from a stored refresh token, so returning users
+    skip the interactive OAuth flow with a single token refresh.
+    """
+    encrypted_token = cookies.get(REFRESH_TOKEN_COOKIE) if cookies is not None else None
+    if not encrypted_token:
+        return None
+    try:
+        fernet = _cookie_fernet(st.secrets["cookie_key"])
+        refresh_token = fernet.decrypt(encrypted_token.encode("ascii")).decode("utf-8")
+    except InvalidToken:
+        # Written under another cookie_key (or tampered with)
+        forget_refresh_token(cookies)
+        return None
+
+    credentials = Credentials(
+        None,
+        refresh_token=refresh_token,
+        token_uri=client_config["web"]["token_uri"],
+        client_id=client_config["web"]["client_id"],
+        client_secret=client_config["web"]["client_secret"],
+        scopes=SCOPES
+    )
+    try:
+        credentials.refresh(Request())
+    except RefreshError:
+        # Revoked or expired; forget it and fall back to signing in
+        forget_refresh_token(cookies)
+        return None
+    except TransportError as e:
+        # Network trouble; keep the token so a reload can retry
+        st.warning(f"Couldn't reach Google to restore your sign-in ({e}). Reload to retry, or sign in again.")
+        return None
+    return credentials
+
+_thread_local = threading.local()
 
-def auth_search_console(client_config, credentials):
+def _thread_http(credentials):
+    """
+    httplib2.Http is not thread-safe, so each thread that calls the API
+    keeps its own keep-alive AuthorizedHttp for the thread's lifetime.
+    """
+    http = getattr(_thread_local, "http", None)
+    if http is None or http.credentials is not credentials:
+        http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
+        _thread_local.http = http
+    return http
+
+class OrjsonModel(JsonModel):
+    """
+    JsonModel that decodes response bodies with orjson; a full 25k-row page
+    spends most of its client-side time in json.loads.
+    """
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+@st.cache_resource(ttl=TOKEN_CACHE_TTL_SECONDS, max_entries=TOKEN_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_webmasters_service(_credentials, access_token):
+    """
+    Discovery client for the Search Console API, built once per access token
+    so Streamlit reruns don't re-download and re-parse the discovery document.
+    The plain Http here only downloads the discovery document; API requests
+    execute on the calling thread's own authorized connection, which makes
+    the shared client safe to use from the chunk-fetch workers.
+    """
+    def build_request(http, *args, **kwargs):
+        return HttpRequest(_thread_http(_credentials), *args, **kwargs)
+
+    return build(
+        "webmasters",
+        "v3",
+        http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS),
+        requestBuilder=build_request,
+        model=OrjsonModel(),
+        cache_discovery=False,
+    )
+
+@st.cache_resource(ttl=TOKEN_CACHE_TTL_SECONDS, max_entries=TOKEN_CACHE_MAX_ENTRIES, show_spinner=False)
+def auth_search_console(client_config, _credentials, access_token):
+    """
+    Authenticated searchconsole account, cached per access token and shared
+    by every chunk of a fetch instead of re-authenticating.
+    """
     token = {
-        "token": credentials.token,
-        "refresh_token": credentials.refresh_token,
-        "token_uri": credentials.token_uri,
-        "client_id": credentials.client_id,
-        "client_secret": credentials.client_secret,
-        "scopes": credentials.scopes,
-        "id_token": getattr(credentials, "id_token", None),
+        "token": _credentials.token,
+        "refresh_token": _credentials.refresh_token,
+        "token_uri": _credentials.token_uri,
+        "client_id": _credentials.client_id,
+        "client_secret": _credentials.client_secret,
+        "scopes": _credentials.scopes,
+        "id_token": getattr(_credentials, "id_token", None),
     }
-    return searchconsole.authenticate(client_config=client_config, credentials=token)
+    account = searchconsole.authenticate(client_config=client_config, credentials=token)
+    # Route the account's queries through the shared, pooled Discovery client
+    account.service = get_webmasters_service(_credentials, access_token)
+    return account
+
+def sign_out():
+    # Runs before the rerun; main() drops the stored token before it would
+    # restore the session from it
+    st.session_state.credentials = None
+    st.session_state.signing_out = True
+
+def show_sign_out_button():
+    with st.sidebar:
+        st.button("Sign out", on_click=sign_out)
 
-def show_google_sign_in(auth_url):
+def show_google_sign_in(client_config, cookies):
     with st.sidebar:
         if st.button("Sign in with Google"):
+            auth_url = start_sign_in(client_config, cookies)
             st.write("Please click the link below to sign in:")
             st.markdown(f"[Google Sign-In]({auth_url})", unsafe_allow_html=True)
 
-def list_gsc_properties(credentials):
-    service = build("webmasters", "v3", credentials=credentials)
+@st.cache_data(ttl=600, show_spinner=False)
+def list_gsc_properties(_credentials, access_token):
+    """
+    Site entries for the signed-in user keyed by site URL, cached per access
+    token so widget reruns don't repeat the sites.list call.
+    """
+    service = get_webmasters_service(_credentials, access_token)
     site_list = service.sites().list().execute()
-    return [site["siteUrl"] for site in site_list.get("siteEntry", [])] or ["No properties found"]
+    return {site["siteUrl"]: site for site in site_list.get("siteEntry", [])}
 
 ###############################################################################
-# 4) Search Console data fetching (chunked, sequential)
+# 3) Search Console data fetching (chunked, parallel)
 ###############################################################################
 
+def _split_keywords(text):
+    """
+    Comma-separated keyword input -> list of non-empty, stripped keywords.
+    """
+    if not text:
+        return []
+    return [kw.strip() for kw in text.split(",") if kw.strip()]
+
+def _keyword_pattern(keywords):
+    """
+    One case-insensitive alternation matching any keyword as a literal
+    substring. Only RE2 metacharacters are escaped (re.escape also escapes
+    spaces, which RE2 rejects), so the same pattern works for the API and re.
+    """
+    return "(?i)" + "|".join(_REGEX_SPECIAL_CHARS.sub(r"\\\g<0>", kw) for kw in keywords)
+
+class RateLimiter:
+    """
+    Caps in-flight Search Console requests with a semaphore and spaces
+    request starts at least 1/rate seconds apart (leaky bucket on the
+    monotonic clock), so we stay under the per-minute quota instead of
+    triggering 429s.
+    """
+
+    def __init__(self, rate, max_concurrent):
+        self._interval = 1.0 / rate
+        self._semaphore = threading.Semaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        return False
+
+GSC_RATE_LIMITER = RateLimiter(MAX_REQUESTS_PER_SECOND, MAX_CONCURRENT_REQUESTS)
+
+def _execute_with_retry(request):
+    """
+    Executes an API request through the rate limiter, retrying quota and
+    transient server errors instead of losing the whole chunk. Backoff
+    starts at ~1s and doubles (with jitter) up to MAX_BACKOFF_SECONDS,
+    so the happy path after a single 429 stays fast.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            with GSC_RATE_LIMITER:
+                return request.execute()
+        except HttpError as e:
+            if e.resp.status not in RETRYABLE_STATUSES or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(min(MAX_BACKOFF_SECONDS, 2 ** attempt + random.random()))
+
+def _build_dimension_filters(
+    dimensions,
+    device_type=None,
+    filter_url=None,
+    filter_keywords=None,
+    filter_keywords_not=None
+):
+    """
+    Dimension filters for the searchAnalytics.query body, so Google only
+    returns rows we keep.
+    """
+    filters = []
+
+    # Device filter if selected
+    if "device" in dimensions and device_type and device_type != "All Devices":
+        filters.append({"dimension": "device", "operator": "equals", "expression": device_type.lower()})
+
+    # Apply the page filter as subfolder filter at the API level
+    if filter_url:
+        filters.append({"dimension": "page", "operator": "contains", "expression": filter_url})
+
+    # Keyword filters as case-insensitive RE2 alternations on the query dimension
+    keywords = _split_keywords(filter_keywords)
+    if keywords:
+        filters.append({
+            "dimension": "query",
+            "operator": "includingRegex",
+            "expression": _keyword_pattern(keywords),
+        })
+    keywords_not = _split_keywords(filter_keywords_not)
+    if keywords_not:
+        filters.append({
+            "dimension": "query",
+            "operator": "excludingRegex",
+            "expression": _keyword_pattern(keywords_not),
+        })
+
+    return filters
+
+@st.cache_resource(show_spinner=False)
+def get_page_executor():
+    """
+    Long-lived pool for follow-up result pages, shared by every fetch. Its
+    threads outlive a single query, so each keeps its keep-alive connection
+    (see _thread_http). Page requests never wait on other work, so chunk
+    workers can block on them without risking a deadlock.
+    st.cache_resource only works on threads with a script run context, so
+    resolve this on the script thread and pass it down to the workers.
+    """
+    return ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS, thread_name_prefix="gsc-page")
+
+def _query_rows(webproperty, body, page_executor, clicks_only=False):
+    """
+    Pages through searchAnalytics.query with startRow, up to MAX_ROWS rows.
+    The first page is fetched on the calling thread; while pages keep coming
+    back full, the following ones go to page_executor in windows of 1, 2,
+    then up to PAGE_FETCH_WINDOW, so a result that ends on a page boundary
+    costs a single empty request.
+    Without a date dimension rows come back sorted by clicks descending, so
+    with clicks_only we stop at the first zero-click row instead of
+    downloading the long tail. Results grouped by date are sorted by date,
+    so there every page is fetched and zero-click rows dropped per page.
+    Returns the kept rows and whether the MAX_ROWS cap cut the result short,
+    which the row count alone can't tell once rows are dropped.
+    """
+    service = webproperty.account.service
+    sorted_by_clicks = "date" not in body.get("dimensions", [])
+    rows = []
+    next_row = 0
+
+    def fetch_page(start_row):
+        page_body = dict(body, rowLimit=API_ROW_LIMIT, startRow=start_row)
+        request = service.searchanalytics().query(siteUrl=webproperty.url, body=page_body)
+        return _execute_with_retry(request).get("rows", [])
+
+    def take(page_rows):
+        """Adds a page to rows; True once no further pages are needed."""
+        nonlocal next_row
+        next_row += len(page_rows)
+        if clicks_only:
+            clicked = [row for row in page_rows if row["clicks"] > 0]
+            rows.extend(clicked)
+            if sorted_by_clicks and len(clicked) < len(page_rows):
+                return True
+        else:
+            rows.extend(page_rows)
+        return len(page_rows) < API_ROW_LIMIT
+
+    finished = take(fetch_page(0))
+    window = 1
+    while not finished and next_row < MAX_ROWS:
+        window_end = min(next_row + window * API_ROW_LIMIT, MAX_ROWS)
+        futures = [
+            page_executor.submit(fetch_page, start_row)
+            for start_row in range(next_row, window_end, API_ROW_LIMIT)
+        ]
+        try:
+            for future in futures:
+                if take(future.result()):
+                    finished = True
+                    break
+        finally:
+            # Drop pages past the end that haven't started yet
+            for future in futures:
+                future.cancel()
+        window = min(2 * window, PAGE_FETCH_WINDOW)
+
+    return rows[:MAX_ROWS], not finished
+
+def _rows_to_dataframe(rows, dimensions):
+    """
+    Builds one column per dimension plus the four metrics straight from the
+    API rows. Metrics go into preallocated int32/float32 arrays via
+    np.fromiter rather than through per-row Python objects.
+    """
+    n = len(rows)
+    key_columns = list(zip(*(row["keys"] for row in rows))) if n else [()] * len(dimensions)
+    data = {dim: np.array(values, dtype=object) for dim, values in zip(dimensions, key_columns)}
+    for column, dtype in METRIC_DTYPES.items():
+        data[column] = np.fromiter((row[column] for row in rows), dtype=dtype, count=n)
+    return pd.DataFrame(data)
+
+def _to_arrow_table(df, dimensions):
+    """
+    Converts a chunk to a pyarrow.Table with a fixed schema. Every dimension
+    is dictionary-encoded (it arrives in pandas as a category), so concat is
+    zero-copy and repeated page/query/country strings are stored once.
+    """
+    fields = [pa.field(dim, DIMENSION_TYPE) for dim in dimensions]
+    return pa.Table.from_pandas(df, schema=pa.schema(fields + METRIC_FIELDS), preserve_index=False)
+
+def _date_chunks(start_date, end_date, chunk_size_days=CHUNK_SIZE_DAYS):
+    """
+    Splits [start_date, end_date] into consecutive, non-overlapping ranges.
+    """
+    starts = pd.date_range(start_date, end_date, freq=f"{chunk_size_days}D")
+    ends = starts + pd.Timedelta(days=chunk_size_days - 1)
+    ends = ends.where(ends <= pd.Timestamp(end_date), pd.Timestamp(end_date))
+    return list(zip(starts.date, ends.date))
+
+def _split_chunk(chunk_start, chunk_end):
+    """
+    Halves a date range that hit the row cap.
+    """
+    mid = chunk_start + (chunk_end - chunk_start) // 2
+    return [(chunk_start, mid), (mid + datetime.timedelta(days=1), chunk_end)]
+
+def _build_query_body(search_type, dimensions, start_date, end_date, filters=None):
+    body = {
+        "startDate": start_date.isoformat(),
+        "endDate": end_date.isoformat(),
+        "type": search_type,
+        "dimensions": list(dimensions),
+    }
+    if filters:
+        body["dimensionFilterGroups"] = [{"groupType": "and", "filters": filters}]
+    return body
+
+def _filter_keywords_locally(df, filter_keywords=None, filter_keywords_not=None):
+    """
+    Python-side keyword filters, only used when the API rejects ours.
+    """
+    keywords = _split_keywords(filter_keywords)
+    keywords_not = _split_keywords(filter_keywords_not)
+    if not keywords and not keywords_not:
+        return df
+    queries = df["query"]
+    mask = np.ones(len(df), dtype=bool)
+    if keywords:
+        mask &= queries.str.contains(re.compile(_keyword_pattern(keywords)), na=False).to_numpy()
+    if keywords_not:
+        mask &= ~queries.str.contains(re.compile(_keyword_pattern(keywords_not)), na=False).to_numpy()
+    return df[mask]
+
 def _fetch_chunk(
     webproperty,
     search_type,
@@ -178,38 +668,53 @@ def _fetch_chunk(
     device_type,
     chunk_start,
     chunk_end,
-    filter_url=None
+    page_executor,
+    filter_keywords=None,
+    filter_keywords_not=None,
+    filter_url=None,
+    clicks_only=False
 ):
     """
-    Helper for a single chunk. 
-    Uses named arguments to ensure the right operator ("contains") is applied,
-    and the expression is your filter_url string.
+    Helper for a single chunk, run on a worker thread (so no st.* calls).
+    The page filter ("contains" your filter_url string), the keyword
+    include/exclude filters and the device filter are sent as
+    dimensionFilterGroups so they apply at the API level.
+    Returns the chunk as an Arrow table and whether it was truncated at
+    MAX_ROWS, counted before any local keyword filtering.
     """
-    st.write(f"[DEBUG] Fetching chunk {chunk_start} -> {chunk_end}")
-
-    query = (
-        webproperty.query
-        .range(chunk_start, chunk_end)
-        .search_type(search_type)
-        .dimension(*dimensions)
+    filters = _build_dimension_filters(
+        dimensions,
+        device_type=device_type,
+        filter_url=filter_url,
+        filter_keywords=filter_keywords,
+        filter_keywords_not=filter_keywords_not
     )
+    body = _build_query_body(search_type, dimensions, chunk_start, chunk_end, filters)
 
-    # Device filter if selected
-    if "device" in dimensions and device_type and device_type != "All Devices":
-        query = query.filter(dimension="device", operator="equals", expression=device_type.lower())
-
-    # Apply the page filter as subfolder filter at the API level
-    if filter_url:
-        st.write("[DEBUG] Applying filter on page => 'contains' =>", filter_url)
-        query = query.filter(dimension="page", operator="contains", expression=filter_url)
+    try:
+        rows, truncated = _query_rows(webproperty, body, page_executor, clicks_only=clicks_only)
+        df_chunk = _rows_to_dataframe(rows, dimensions)
+    except HttpError as e:
+        # A 400 here means Google rejected a keyword regex (not valid RE2, or
+        # too long). Refetch without the keyword filters and apply them locally.
+        has_keyword_filters = _split_keywords(filter_keywords) or _split_keywords(filter_keywords_not)
+        if e.resp.status != 400 or not has_keyword_filters or "query" not in dimensions:
+            raise
+        filters = _build_dimension_filters(dimensions, device_type=device_type, filter_url=filter_url)
+        body = _build_query_body(search_type, dimensions, chunk_start, chunk_end, filters)
+        rows, truncated = _query_rows(webproperty, body, page_executor, clicks_only=clicks_only)
+        df_chunk = _filter_keywords_locally(
+            _rows_to_dataframe(rows, dimensions),
+            filter_keywords,
+            filter_keywords_not
+        )
 
-    df_chunk = query.limit(250000).get().to_dataframe()
-    df_chunk.reset_index(drop=True, inplace=True)
-    st.write(f"[DEBUG] Got {len(df_chunk)} rows for chunk {chunk_start}->{chunk_end}")
-    return df_chunk
+    return _to_arrow_table(df_chunk, dimensions), truncated
 
+@st.cache_data(ttl=FETCH_CACHE_TTL_SECONDS, max_entries=FETCH_CACHE_MAX_ENTRIES, show_spinner=False)
 def fetch_gsc_data_in_chunks(
-    webproperty,
+    _webproperty,
+    property_url,
     search_type,
     start_date,
     end_date,
@@ -217,114 +722,161 @@ def fetch_gsc_data_in_chunks(
     device_type=None,
     filter_keywords=None,
     filter_keywords_not=None,
-    filter_url=None
+    filter_url=None,
+    clicks_only=False
 ):
     """
-    Fetches data in ~3-month (90-day) increments sequentially,
-    combining into a single DataFrame. The subfolder/page filter
-    is applied at the API level to avoid missing data.
+    Fetches data in ~3-month (90-day) increments in parallel,
+    combining into a single DataFrame. A chunk whose query hit the
+    MAX_ROWS cap was truncated, so it is split in half and re-fetched.
+    The subfolder/page and keyword filters are applied at the API level
+    to avoid missing data, and with clicks_only zero-click rows are
+    never downloaded.
+    Results are cached for an hour per property_url and query parameters,
+    so re-fetching the same report doesn't hit the API again. If any chunk
+    fails, RuntimeError is raised once the in-flight chunks finish, so a
+    partial report is never cached.
     """
-    st.write("**Info:** Fetching data in smaller chunks (sequential).")
+    st.write("**Info:** Fetching data in smaller chunks (parallel).")
+    if filter_url:
+        st.write("[DEBUG] Applying filter on page => 'contains' =>", filter_url)
 
-    chunk_size_days = 90
-    current_start = start_date
     results = []
-
-    while current_start <= end_date:
-        current_end = current_start + datetime.timedelta(days=chunk_size_days - 1)
-        if current_end > end_date:
-            current_end = end_date
-
-        try:
-            df_chunk = _fetch_chunk(
-                webproperty=webproperty,
+    errors = []
+
+    # Chunks waiting to be submitted; at most 2x workers futures are in flight
+    queued = deque(_date_chunks(start_date, end_date))
+    max_in_flight = 2 * MAX_FETCH_WORKERS
+    # Resolved here: the chunk workers have no script context to look it up
+    page_executor = get_page_executor()
+
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+        pending = {}
+
+        def submit(chunk_start, chunk_end):
+            st.write(f"[DEBUG] Fetching chunk {chunk_start} -> {chunk_end}")
+            future = executor.submit(
+                _fetch_chunk,
+                webproperty=_webproperty,
                 search_type=search_type,
                 dimensions=dimensions,
                 device_type=device_type,
-                chunk_start=current_start,
-                chunk_end=current_end,
-                filter_url=filter_url
+                chunk_start=chunk_start,
+                chunk_end=chunk_end,
+                page_executor=page_executor,
+                filter_keywords=filter_keywords,
+                filter_keywords_not=filter_keywords_not,
+                filter_url=filter_url,
+                clicks_only=clicks_only
             )
-            results.append(df_chunk)
-        except Exception as e:
-            st.write(f"[ERROR] Chunk {current_start}->{current_end} failed: {e}")
-
-        current_start = current_end + datetime.timedelta(days=1)
-
-    # Combine all chunks
+            pending[future] = (chunk_start, chunk_end)
+
+        def fill():
+            while queued and len(pending) < max_in_flight:
+                submit(*queued.popleft())
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_start, chunk_end = pending.pop(future)
+                try:
+                    table, truncated = future.result()
+                except Exception as e:
+                    st.write(f"[ERROR] Chunk {chunk_start}->{chunk_end} failed: {e}")
+                    errors.append((chunk_start, chunk_end, e))
+                    # The report is incomplete now; don't start more chunks
+                    queued.clear()
+                    continue
+
+                if truncated and chunk_start < chunk_end:
+                    st.write(f"[DEBUG] Chunk {chunk_start}->{chunk_end} hit the {MAX_ROWS}-row cap, splitting it")
+                    queued.extendleft(reversed(_split_chunk(chunk_start, chunk_end)))
+                    continue
+
+                st.write(f"[DEBUG] Got {table.num_rows} rows for chunk {chunk_start}->{chunk_end}")
+                results.append((chunk_start, table))
+            fill()
+
+    if errors:
+        chunk_start, chunk_end, error = errors[0]
+        raise RuntimeError(
+            f"{len(errors)} date chunk(s) failed, first {chunk_start}->{chunk_end}: {error}"
+        ) from error
+
+    # Combine all chunks, in date order, without leaving Arrow
     if results:
-        df_all = pd.concat(results, ignore_index=True)
-        # Remove duplicates if you suspect overlap
-        df_all.drop_duplicates(
-            subset=dimensions + ["clicks", "impressions", "ctr", "position"],
-            inplace=True
-        )
+        results.sort(key=lambda item: item[0])
+        # Chunks cover disjoint date ranges, so there is nothing to dedup
+        combined = pa.concat_tables([table for _, table in results]).unify_dictionaries()
+        # Convert to pandas only once, for display/CSV
+        df_all = combined.to_pandas()
     else:
         df_all = pd.DataFrame()
 
-    # Keyword (query) filters after chunking
-    if not df_all.empty:
-        # Filter: includes
-        if filter_keywords:
-            keywords = [kw.strip() for kw in filter_keywords.split(",")]
-            df_all = df_all[df_all["query"].str.contains("|".join(keywords), case=False, na=False)]
-        # Filter: excludes
-        if filter_keywords_not:
-            for kw_not in filter_keywords_not.split(","):
-                df_all = df_all[~df_all["query"].str.contains(kw_not.strip(), case=False, na=False)]
-
-        # NOTE: We do not do a post-filter for filter_url because 
-        # we already filtered at the API level.
+    # NOTE: No post-filters for filter_url or keywords because
+    # we already filtered at the API level.
 
+    # Stamped inside the cache, so every hit carries the same value and a
+    # refetch after expiry gets a new one (see serialize_report)
+    df_all.attrs["fetched_at"] = time.time()
     return df_all
 
-def fetch_compare_data(webproperty, search_type, compare_start_date, compare_end_date, dimensions, device_type=None):
+@st.cache_data(ttl=FETCH_CACHE_TTL_SECONDS, max_entries=FETCH_CACHE_MAX_ENTRIES, show_spinner=False)
+def fetch_compare_data(
+    _webproperty,
+    property_url,
+    search_type,
+    compare_start_date,
+    compare_end_date,
+    dimensions,
+    device_type=None
+):
     """
     Comparison is done with a single 250k-limit call (not chunked).
+    Cached like fetch_gsc_data_in_chunks; errors propagate so a failed
+    fetch is never cached.
     """
     st.write("Fetching comparison data (single query).")
-    progress = st.progress(0.5)
-    query = (
-        webproperty.query
-        .range(compare_start_date, compare_end_date)
-        .search_type(search_type)
-        .dimension(*dimensions)
-    )
-
-    if "device" in dimensions and device_type and device_type != "All Devices":
-        query = query.filter(dimension="device", operator="equals", expression=device_type.lower())
-
-    try:
-        df = query.limit(250000).get().to_dataframe()
-        df.reset_index(drop=True, inplace=True)
-        st.write("Comparison data fetched.")
-        progress.progress(1.0)
-        return df
-    except Exception as e:
-        st.error(f"Comparison fetch error: {e}")
-        progress.progress(1.0)
-        return pd.DataFrame()
+    filters = _build_dimension_filters(dimensions, device_type)
+    body = _build_query_body(search_type, dimensions, compare_start_date, compare_end_date, filters)
+
+    rows, truncated = _query_rows(_webproperty, body, get_page_executor())
+    if truncated:
+        st.write(f"[DEBUG] Comparison data hit {MAX_ROWS} rows; the rest was not fetched")
+    df = _rows_to_dataframe(rows, dimensions)
+    # Same compact dtypes as the chunked report: categorical dimensions
+    df = df.astype({dim: "category" for dim in dimensions})
+    df.attrs["fetched_at"] = time.time()
+    st.write("Comparison data fetched.")
+    return df
+
+def clear_fetch_cache():
+    fetch_gsc_data_in_chunks.clear()
+    fetch_compare_data.clear()
 
 ###############################################################################
-# 5) UI and final bits
+# 4) UI and final bits
 ###############################################################################
 
 def property_change():
     st.session_state.selected_property = st.session_state["selected_property_selector"]
 
 def show_property_selector(properties, account):
+    property_urls = list(properties)
     selected_property = st.selectbox(
         "Select a Search Console Property:",
-        properties,
-        index=properties.index(st.session_state.selected_property)
+        property_urls,
+        index=property_urls.index(st.session_state.selected_property)
         if st.session_state.selected_property in properties else 0,
         key="selected_property_selector",
         on_change=property_change
     )
-    return account[selected_property]
+    # Built from the cached site entry; account[url] would re-list every site.
+    return searchconsole.account.WebProperty(properties[selected_property], account)
 
 def update_dimensions(selected_search_type):
-    return BASE_DIMENSIONS + ["device"] if selected_search_type in SEARCH_TYPES else BASE_DIMENSIONS
+    return DEVICE_DIMENSIONS if selected_search_type in SEARCH_TYPES else BASE_DIMENSIONS
 
 def show_search_type_selector():
     return st.selectbox(
@@ -379,37 +931,110 @@ def show_comparison_option():
         st.session_state.compare_start_date = st.date_input("Comparison Start Date", st.session_state.compare_start_date)
         st.session_state.compare_end_date = st.date_input("Comparison End Date", st.session_state.compare_end_date)
 
+def show_query_form():
+    """
+    Filters and export format sit in a form with the fetch button, so editing
+    them doesn't rerun the script until Fetch Data is pressed.
+    """
+    with st.form("query_form"):
+        show_filter_options()
+        show_export_format_selector()
+        return st.form_submit_button("Fetch Data")
+
 def show_filter_options():
     st.session_state.filter_keywords = st.text_input("Keyword Filter (contains, separate multiple with commas)")
     st.session_state.filter_keywords_not = st.text_input("Keyword Filter (does not contain, separate multiple with commas)")
     st.session_state.filter_url = st.text_input("URL or Subfolder Filter (contains)")
+    st.session_state.clicks_only = st.checkbox("Only include rows with clicks", value=st.session_state.clicks_only)
+
+def show_clear_cache_button():
+    with st.sidebar:
+        if st.button("Clear cached data"):
+            clear_fetch_cache()
+            st.write("Cached Search Console data cleared.")
 
 def show_dataframe(report):
-    with st.expander("Preview the First 100 Rows"):
-        st.dataframe(report.head(100))
+    with st.expander(f"Preview the First {DF_PREVIEW_ROWS} Rows"):
+        st.dataframe(report.head(DF_PREVIEW_ROWS))
+
+def show_export_format_selector():
+    st.session_state.export_format = st.radio(
+        "Download Format:",
+        EXPORT_FORMATS,
+        index=EXPORT_FORMATS.index(st.session_state.export_format),
+        horizontal=True
+    )
 
-def download_csv_link(report):
-    try:
-        report.reset_index(drop=True, inplace=True)
+def _write_csv(report, sink):
+    """
+    UTF-8 CSV (with a BOM so Excel detects the encoding) written by Arrow's
+    C++ writer in a single pass, rather than building the whole text in Python.
+    """
+    sink.write(b"\xef\xbb\xbf")
+    table = pa.Table.from_pandas(report, preserve_index=False)
+    pa_csv.write_csv(table, sink, pa_csv.WriteOptions(quoting_style="needed"))
 
-        def to_csv(df):
-            return df.to_csv(index=False, encoding="utf-8-sig")
+@st.cache_data(show_spinner=False, max_entries=4)
+def serialize_report(_report, report_key, export_format="CSV"):
+    """
+    Encodes a report once per (result set, format); a repeated fetch that hits
+    the data cache reuses the bytes instead of re-running to_csv/to_parquet.
+    Keyed on report_key rather than the frame, which Streamlit only samples
+    when hashing large DataFrames.
+    """
+    # Write straight into a bytes buffer; st.download_button serves it
+    # as a file, with no str copy and no base64 data URL in the page
+    buf = io.BytesIO()
+    if export_format == "Parquet":
+        _report.to_parquet(buf, index=False, compression="zstd")
+        file_name, mime = "search_console_data.parquet", "application/vnd.apache.parquet"
+    elif export_format == "CSV.gz":
+        with gzip.GzipFile(fileobj=buf, mode="wb") as sink:
+            _write_csv(_report, sink)
+        file_name, mime = "search_console_data.csv.gz", "application/gzip"
+    else:
+        _write_csv(_report, buf)
+        file_name, mime = "search_console_data.csv", "text/csv"
+    return buf.getvalue(), file_name, mime
 
-        csv = to_csv(report)
-        b64_csv = base64.b64encode(csv.encode()).decode()
-        href = f'<a href="data:file/csv;base64,{b64_csv}" download="search_console_data.csv">Download CSV File</a>'
-        st.markdown(href, unsafe_allow_html=True)
+def download_report(report, report_key, export_format="CSV"):
+    try:
+        report.reset_index(drop=True, inplace=True)
+        data, file_name, mime = serialize_report(report, report_key, export_format)
+        st.download_button(
+            f"Download {export_format} File",
+            data=data,
+            file_name=file_name,
+            mime=mime
+        )
     except Exception as e:
-        st.error(f"Error converting DataFrame to CSV: {e}")
+        st.error(f"Error converting DataFrame to {export_format}: {e}")
 
 def compare_data(report, compare_report):
+    # Give both sides the same categories for each join key, so pandas
+    # joins on integer codes instead of hashing the page/query strings
+    for key in COMPARE_KEYS:
+        categories = union_categoricals(
+            [report[key].astype("category"), compare_report[key].astype("category")]
+        ).categories
+        key_dtype = pd.CategoricalDtype(categories)
+        report = report.assign(**{key: report[key].astype(key_dtype)})
+        compare_report = compare_report.assign(**{key: compare_report[key].astype(key_dtype)})
+
     merged_report = report.merge(
         compare_report,
-        on=["page", "query"],
+        on=COMPARE_KEYS,
+        how="inner",
+        sort=False,
         suffixes=("_current", "_compare")
     )
-    merged_report["clicks_diff"] = merged_report["clicks_current"] - merged_report["clicks_compare"]
-    merged_report["impressions_diff"] = merged_report["impressions_current"] - merged_report["impressions_compare"]
+    # Aligned numpy subtraction; skips Series index alignment
+    merged_report["clicks_diff"] = (
+        merged_report["clicks_current"].to_numpy() - merged_report["clicks_compare"].to_numpy()
+    )
+    merged_report["impressions_diff"] = (
+        merged_report["impressions_current"].to_numpy() - merged_report["impressions_compare"].to_numpy()
+    )
     return merged_report
 
 def show_dimensions_selector(search_type):
@@ -421,7 +1046,7 @@ def show_dimensions_selector(search_type):
         key="dimensions_selector"
     )
 
-def show_fetch_data_button(
+def show_fetch_results(
     webproperty,
     search_type,
     start_date,
@@ -429,28 +1054,52 @@ def show_fetch_data_button(
     selected_dimensions,
     filter_keywords,
     filter_keywords_not,
-    filter_url
+    filter_url,
+    clicks_only=False
 ):
-    if st.button("Fetch Data"):
-        progress = st.progress(0)
-        # If comparing time periods
-        if st.session_state.compare:
-            compare_start_date = st.session_state.compare_start_date
-            compare_end_date = st.session_state.compare_end_date
-            compare_report = fetch_compare_data(
-                webproperty,
-                search_type,
-                compare_start_date,
-                compare_end_date,
-                selected_dimensions,
-                st.session_state.selected_device
+    progress = st.progress(0)
+    # Identifies a result set for serialize_report; the fetched_at stamps
+    # added below tell a cache hit apart from a refetch
+    report_key = (
+        webproperty.url,
+        search_type,
+        start_date,
+        end_date,
+        tuple(selected_dimensions),
+        st.session_state.selected_device,
+        filter_keywords,
+        filter_keywords_not,
+        filter_url,
+        clicks_only,
+    )
+    # If comparing time periods
+    if st.session_state.compare:
+        compare_start_date = st.session_state.compare_start_date
+        compare_end_date = st.session_state.compare_end_date
+        device_type = st.session_state.selected_device
+
+        # Fetch the comparison range on a side thread while the main range
+        # is fetched in chunks; both go through the same rate limiter
+        ctx = get_script_run_ctx()
+
+        def fetch_compare():
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return fetch_compare_data(
+                _webproperty=webproperty,
+                property_url=webproperty.url,
+                search_type=search_type,
+                compare_start_date=compare_start_date,
+                compare_end_date=compare_end_date,
+                dimensions=selected_dimensions,
+                device_type=device_type
             )
-            if not compare_report.empty:
-                st.write("### Comparison data fetched successfully!")
 
-                # Now fetch the main data in chunked, sequential manner
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            compare_future = executor.submit(fetch_compare)
+            try:
                 report = fetch_gsc_data_in_chunks(
-                    webproperty=webproperty,
+                    _webproperty=webproperty,
+                    property_url=webproperty.url,
                     search_type=search_type,
                     start_date=start_date,
                     end_date=end_date,
@@ -458,19 +1107,44 @@ def show_fetch_data_button(
                     device_type=st.session_state.selected_device,
                     filter_keywords=filter_keywords,
                     filter_keywords_not=filter_keywords_not,
-                    filter_url=filter_url
+                    filter_url=filter_url,
+                    clicks_only=clicks_only
                 )
-                merged_report = compare_data(report, compare_report)
-                progress.progress(0.8)
-                show_dataframe(merged_report)
-                download_csv_link(merged_report)
-            else:
-                st.write("No comparison data found for the selected parameters.")
-            progress.progress(1.0)
+            except Exception as e:
+                report = None
+                show_error(e)
+            try:
+                compare_report = compare_future.result()
+            except Exception as e:
+                st.error(f"Comparison fetch error: {e}")
+                compare_report = pd.DataFrame()
+        if report is None:
+            return
+        progress.progress(0.5)
+        if not compare_report.empty:
+            st.write("### Comparison data fetched successfully!")
+            merged_report = compare_data(report, compare_report)
+            progress.progress(0.8)
+            show_dataframe(merged_report)
+            download_report(
+                merged_report,
+                report_key + (
+                    compare_start_date,
+                    compare_end_date,
+                    report.attrs.get("fetched_at"),
+                    compare_report.attrs.get("fetched_at"),
+                ),
+                st.session_state.export_format
+            )
         else:
-            # Single date range, chunked
+            st.write("No comparison data found for the selected parameters.")
+        progress.progress(1.0)
+    else:
+        # Single date range, chunked
+        try:
             df = fetch_gsc_data_in_chunks(
-                webproperty=webproperty,
+                _webproperty=webproperty,
+                property_url=webproperty.url,
                 search_type=search_type,
                 start_date=start_date,
                 end_date=end_date,
@@ -478,58 +1152,80 @@ def show_fetch_data_button(
                 device_type=st.session_state.selected_device,
                 filter_keywords=filter_keywords,
                 filter_keywords_not=filter_keywords_not,
-                filter_url=filter_url
+                filter_url=filter_url,
+                clicks_only=clicks_only
             )
-            if not df.empty:
-                st.write(f"### Data fetched successfully! Rows: {len(df)}")
-                show_dataframe(df)
-                download_csv_link(df)
-            else:
-                st.write("No data found for the selected parameters.")
-        progress.progress(1.0)
+        except Exception as e:
+            show_error(e)
+            return
+        if not df.empty:
+            st.write(f"### Data fetched successfully! Rows: {len(df)}")
+            show_dataframe(df)
+            download_report(
+                df,
+                report_key + (df.attrs.get("fetched_at"),),
+                st.session_state.export_format
+            )
+        else:
+            st.write("No data found for the selected parameters.")
+    progress.progress(1.0)
 
 ###############################################################################
-# 6) Main entry point
+# 5) Main entry point
 ###############################################################################
 
 def main():
     setup_streamlit()
     client_config = load_config()
+    cookies = get_cookie_manager()
+    if st.session_state.pop("signing_out", False):
+        forget_refresh_token(cookies)
 
-    # 1) Prepare OAuth
-    flow, auth_url = google_auth(client_config)
-    st.session_state.auth_flow = flow
-    st.session_state.auth_url = auth_url
+    # 1) Read the OAuth callback; st.query_params returns single strings
+    auth_code = st.query_params.get("code")
+    auth_state = st.query_params.get("state")
+    st.write("**Debug:** st.query_params code =>", auth_code)
 
-    # 2) Gather query params with older Streamlit method
-    params = st.experimental_get_query_params()
-    st.write("**Debug:** st.experimental_get_query_params =>", params)
-
-    # 3) Reassemble code if truncated
-    auth_code = reassemble_auth_code(params)
-    st.write("**Debug:** reassembled auth_code =>", auth_code)
-
-    # 4) Exchange token if we have code & no existing credentials
+    # 2) Exchange token if we have code & no existing credentials
     if auth_code and not st.session_state.get("credentials"):
         try:
             st.write("**Debug:** Attempting to fetch token with code:", auth_code)
-            st.session_state.auth_flow.fetch_token(code=auth_code)
-            st.session_state.credentials = st.session_state.auth_flow.credentials
-            # Clear code from URL
-            st.experimental_set_query_params()
+            st.session_state.credentials = exchange_auth_code(
+                client_config,
+                cookies,
+                auth_code,
+                auth_state
+            )
+            save_refresh_token(cookies, st.session_state.credentials)
             st.write("**Debug:** Token fetched successfully.")
         except Exception as e:
             st.error(f"Error fetching token: {e}")
+        # The code is single-use either way; clear it from the URL
+        st.query_params.clear()
 
-    # 5) If still no credentials, prompt sign-in
+    # 3) Otherwise try a refresh token saved by an earlier session
     if not st.session_state.get("credentials"):
-        show_google_sign_in(st.session_state.auth_url)
+        st.session_state.credentials = load_credentials_from_cookie(cookies, client_config)
+
+    # 4) If still no credentials, prompt sign-in
+    if not st.session_state.get("credentials"):
+        show_google_sign_in(client_config, cookies)
+        save_cookies(cookies)
         return
+    save_cookies(cookies)
 
-    # 6) We have credentials; proceed with the app
+    # 5) We have credentials; proceed with the app
+    show_sign_out_button()
     init_session_state()
-    account = auth_search_console(client_config, st.session_state.credentials)
-    properties = list_gsc_properties(st.session_state.credentials)
+    account = auth_search_console(
+        client_config,
+        st.session_state.credentials,
+        st.session_state.credentials.token
+    )
+    properties = list_gsc_properties(
+        st.session_state.credentials,
+        st.session_state.credentials.token
+    )
 
     if properties:
         webproperty = show_property_selector(properties, account)
@@ -552,17 +1248,22 @@ def main():
         # )
 
         show_comparison_option()
-        show_filter_options()
-        show_fetch_data_button(
-            webproperty,
-            search_type,
-            start_date,
-            end_date,
-            selected_dimensions,
-            st.session_state.filter_keywords,
-            st.session_state.filter_keywords_not,
-            st.session_state.filter_url
-        )
+        fetch_requested = show_query_form()
+        show_clear_cache_button()
+        if fetch_requested:
+            show_fetch_results(
+                webproperty,
+                search_type,
+                start_date,
+                end_date,
+                selected_dimensions,
+                st.session_state.filter_keywords,
+                st.session_state.filter_keywords_not,
+                st.session_state.filter_url,
+                st.session_state.clicks_only
+            )
+    else:
+        st.warning("No Search Console properties found for this account.")
 
 if __name__ == "__main__":
     main()